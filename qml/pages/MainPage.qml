@@ -16,6 +16,7 @@ Page {
     property string lastStatusCheck: "Never"
     property bool isMicON: true
     property bool isSpeaker: false
+    property var callHistoryEntry: null // history entry of the current call
     
     // Вычисляемые свойства для автоматического обновления UI
     property string callStatusText: {
@@ -351,14 +352,20 @@ Page {
 		var status = callInfo.match(/\(([^)]+)\)$/)
 		status = status ? status[1] : "none"
 		//if (callState==="outgoing" && status==="active") callStartTime = new Date()
+		var number = callInfo.match(/Call:\s*([^\s\(]+)/)
+		number = number ? number[1] : "Unknown"
+		
 		if (callState!==status) {
+			if (status==="none") callEnded()
+			else if (!callHistoryEntry) {
+				// Calls not started from the GUI get their history entry here
+				addToHistory(number, status==="outgoing" ? "outgoing" : "incoming")
+				callHistoryEntry = callHistory[0]
+			}
 			callStartTime = new Date()
 			callState = status
 		}
 		
-		var number = callInfo.match(/Call:\s*([^\s\(]+)/)
-		number = number ? number[1] : "Unknown"
-		
 		if (status!=="none") {
 			currentCallNumber = number
 			updateCallDuration()
@@ -369,6 +376,7 @@ Page {
 	
 	function makeCallHandler(result) {
 		console.log("GUI: make_call result:", result)
+		if (!result) callHistoryEntry = null
 		if (result) {
 			callState = "outgoing"
 			numberField.text = ""
@@ -379,12 +387,14 @@ Page {
     function makeCall(number) {
         if ( (!isRegistered) || (callState !== "none") ) return
         addToHistory(number, "outgoing")
+        callHistoryEntry = callHistory[0]
         linphoneService.call('make_call', [number], makeCallHandler)
 		//currentCallNumber = number
 		//console.log("GUI: Set state to 'outgoing' for number:", number)
     }
 
 	function endCallHandler(result) {
+		callEnded()
 		callState = "none"
 		console.log("GUI: Hang up result:", result)
 	}
@@ -479,6 +489,22 @@ Page {
         saveCallHistory()
     }
     
+    function callEnded() {
+        // Runs for hang-ups from the GUI and for calls ended remotely; only the first one counts
+        var entry = callHistoryEntry
+        callHistoryEntry = null
+        if (entry) attachRecordingToHistory(entry)
+    }
+    
+    function attachRecordingToHistory(entry) {
+        linphoneService.call('get_recording_path', [], function(path) {
+            if (!path) return
+            console.log("GUI: Call recording:", path)
+            entry.recording = path
+            saveCallHistory()
+        })
+    }
+    
     function removeFromHistory(index) {
         callHistory.splice(index, 1)
         saveCallHistory()
@@ -15,6 +15,7 @@ URL:        http://example.org/
 Source0:    %{name}-%{version}.tar.bz2
 Requires:   sailfishsilica-qt5 >= 0.10.9
 Requires:   pyotherside-qml-plugin-python3-qt5 >= 1.3, libsailfishapp-launcher
+Requires:   opus-tools, pulseaudio-utils
 #BuildRequires:  pkgconfig(sailfishapp) >= 1.0.2
 #BuildRequires:  pkgconfig(Qt5Core)
 #BuildRequires:  pkgconfig(Qt5Qml)
@@ -4,8 +4,11 @@ import sys
 import time
 import signal
 import logging
+import shutil
 import subprocess
 import threading
+from array import array
+from datetime import datetime
 from pathlib import Path
 import pulsectl
 import dbus
@@ -52,6 +55,277 @@ class LinphoneStates:
         if console_state not in console_states: return None
         return script_states[console_states.index(console_state)]
 
+# Application names used to recognise linphone's PulseAudio streams
+CALL_STREAM_KEYWORDS = ['linphone', 'call', 'voip']
+
+class RecordingSession:
+    """One recording: per-stream capture threads, a mixer thread and the encoder"""
+    
+    def __init__(self, recorder, path):
+        self.recorder = recorder
+        self.path = path
+        self.logger = recorder.logger
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.__lock = threading.Lock()
+        self.__capture = []
+        self.__buffers = {'remote': bytearray(), 'local': bytearray()}
+    
+    @property
+    def recording(self):
+        return self.thread.is_alive() and not self.stop_event.is_set()
+    
+    def start(self):
+        self.thread.start()
+    
+    def stop(self):
+        """Ask the session to finish; the encoder drains in the background"""
+        self.stop_event.set()
+        with self.__lock:
+            for proc in self.__capture:
+                if proc.poll() is None:
+                    proc.terminate()
+    
+    def __push(self, side, data):
+        with self.__lock:
+            buf = self.__buffers[side]
+            buf += data
+            # Keep buffers small; drop the oldest whole samples on overflow
+            excess = len(buf) - CallRecorder.MAX_BUFFER_BYTES
+            if excess > 0:
+                del buf[:excess + excess % 2]
+    
+    def __take(self, side):
+        """Take one chunk of whole samples, padded with silence if the stream is late"""
+        with self.__lock:
+            buf = self.__buffers[side]
+            size = min(len(buf), CallRecorder.CHUNK_BYTES)
+            size -= size % 2
+            data = bytes(buf[:size])
+            del buf[:size]
+        return data + bytes(CallRecorder.CHUNK_BYTES - size)
+    
+    def __capture_stream(self, side):
+        """Capture one side of the call, re-attaching when linphone replaces its stream"""
+        while not self.stop_event.is_set():
+            try:
+                device_args = self.recorder.find_call_stream(side)
+            except Exception as e:
+                self.logger.error(f"Recording {side} stream lookup error: {e}")
+                device_args = None
+            if device_args is None:
+                self.stop_event.wait(CallRecorder.RESOLVE_INTERVAL)
+                continue
+            
+            with self.__lock:
+                if self.stop_event.is_set():
+                    return
+                proc = subprocess.Popen(
+                    ['parec', '--raw', '--format=s16le', f'--rate={CallRecorder.SAMPLE_RATE}',
+                     '--channels=1', '--latency-msec=100', *device_args],
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+                )
+                self.__capture.append(proc)
+            self.logger.info(f"Recording {side} stream attached: {' '.join(device_args)}")
+            
+            try:
+                fd = proc.stdout.fileno()
+                while True:
+                    data = os.read(fd, CallRecorder.CHUNK_BYTES)
+                    if not data:
+                        break
+                    self.__push(side, data)
+            except Exception as e:
+                self.logger.error(f"Recording {side} capture error: {e}")
+            finally:
+                with self.__lock:
+                    self.__capture.remove(proc)
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+                proc.stdout.close()
+            
+            if not self.stop_event.is_set():
+                # Hold/resume, re-INVITE or a stream move ends parec; silence is
+                # recorded for this side until the new stream is found
+                self.logger.info(f"Recording {side} stream lost, re-resolving")
+                self.stop_event.wait(CallRecorder.RESOLVE_INTERVAL)
+    
+    def __run(self):
+        error = None
+        encoder = None
+        try:
+            self.recorder.enforce_budget()
+            encoder = subprocess.Popen(
+                ['opusenc', '--quiet', '--raw', '--raw-bits', '16',
+                 '--raw-rate', str(CallRecorder.SAMPLE_RATE), '--raw-chan', '1',
+                 '--speech', '-', str(self.path)],
+                stdin=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+            for side in self.__buffers:
+                threading.Thread(target=self.__capture_stream, args=(side,), daemon=True).start()
+            self.logger.info(f"Recording started: {self.path}")
+            
+            # Mix on a fixed timeline so both sides stay in sync even when one
+            # of them stalls; only a few chunks per side are ever buffered
+            since_check = 0
+            next_tick = time.monotonic()
+            while not self.stop_event.is_set():
+                next_tick += CallRecorder.CHUNK_SECONDS
+                delay = next_tick - time.monotonic()
+                if delay < -1.0:
+                    next_tick = time.monotonic()
+                elif delay > 0 and self.stop_event.wait(delay):
+                    break
+                chunk = CallRecorder.mix(self.__take('remote'), self.__take('local'))
+                encoder.stdin.write(chunk)
+                since_check += len(chunk)
+                if since_check >= CallRecorder.BUDGET_CHECK_BYTES:
+                    since_check = 0
+                    self.recorder.enforce_budget()
+        except Exception as e:
+            error = str(e)
+            self.logger.error(f"Recording error: {e}")
+        finally:
+            self.stop()
+            if encoder is not None:
+                # Closing stdin lets opusenc finalize the file before we give up on it
+                try:
+                    encoder.stdin.close()
+                except Exception:
+                    pass
+                try:
+                    encoder.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.logger.error(f"Recording encoder did not finish: {self.path}")
+                    encoder.kill()
+                    encoder.wait()
+            self.logger.info(f"Recording finished: {self.path}")
+            self.recorder.session_finished(self, error)
+
+
+class CallRecorder:
+    """Streams linphone call audio through a background encoder into .opus files"""
+    
+    SAMPLE_RATE = 16000
+    CHUNK_SECONDS = 0.1
+    CHUNK_BYTES = int(SAMPLE_RATE * CHUNK_SECONDS) * 2  # s16le mono
+    MAX_BUFFER_BYTES = CHUNK_BYTES * 10  # at most 1 s buffered per side
+    BUDGET_CHECK_BYTES = SAMPLE_RATE * 2 * 30  # re-check disk budget every 30 s of audio
+    RESOLVE_INTERVAL = 0.5
+    REQUIRED_TOOLS = ['parec', 'opusenc']
+    
+    def __init__(self, record_dir, budget_bytes, on_finished=None):
+        self.record_dir = Path(record_dir)
+        self.record_dir.mkdir(parents=True, exist_ok=True)
+        self.budget_bytes = budget_bytes
+        self.on_finished = on_finished
+        self.logger = logging.getLogger('LinphoneDaemon')
+        self.__session = None
+        self.__sessions = []
+        self.__lock = threading.Lock()
+    
+    @property
+    def recording(self):
+        return self.__session is not None and self.__session.recording
+    
+    def missing_tools(self):
+        return [tool for tool in self.REQUIRED_TOOLS if shutil.which(tool) is None]
+    
+    def start(self, number):
+        """Start recording the current call, returns the target file path.
+        
+        A previous session that is still draining its encoder keeps running
+        alongside the new one.
+        """
+        if self.recording:
+            return self.__session.path
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        safe_number = ''.join(c for c in str(number) if c.isalnum() or c in '+-_') or 'unknown'
+        path = self.record_dir / f"{stamp}_{safe_number}.opus"
+        suffix = 1
+        while path.exists() or any(s.path == path for s in self.__sessions):
+            path = self.record_dir / f"{stamp}_{safe_number}_{suffix}.opus"
+            suffix += 1
+        session = RecordingSession(self, path)
+        with self.__lock:
+            self.__sessions.append(session)
+        self.__session = session
+        session.start()
+        return path
+    
+    def stop(self):
+        """Stop the current session; does not block the caller"""
+        if self.__session is not None:
+            self.__session.stop()
+    
+    def stop_all(self, timeout=15):
+        """Stop every session and wait for the encoders to finalize their files"""
+        with self.__lock:
+            sessions = list(self.__sessions)
+        for session in sessions:
+            session.stop()
+        deadline = time.monotonic() + timeout
+        for session in sessions:
+            session.thread.join(max(0, deadline - time.monotonic()))
+            if session.thread.is_alive():
+                self.logger.error(f"Recording not finalized before shutdown: {session.path}")
+    
+    def session_finished(self, session, error):
+        with self.__lock:
+            self.__sessions.remove(session)
+        self.enforce_budget(keep={session.path})
+        if self.on_finished:
+            self.on_finished(session.path, error)
+    
+    def enforce_budget(self, keep=()):
+        """Delete oldest recordings until the directory fits into the disk budget"""
+        with self.__lock:
+            keep = set(keep) | {session.path for session in self.__sessions}
+        try:
+            files = []
+            for entry in os.scandir(self.record_dir):
+                if entry.is_file() and entry.name.endswith('.opus'):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, Path(entry.path)))
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if total <= self.budget_bytes:
+                    break
+                if path in keep:
+                    continue
+                path.unlink(missing_ok=True)
+                total -= size
+                self.logger.info(f"Recording evicted (disk budget): {path}")
+        except Exception as e:
+            self.logger.error(f"Recording budget error: {e}")
+    
+    def find_call_stream(self, side):
+        """Return parec device arguments for one side of the call, or None"""
+        with pulsectl.Pulse('linphoneui-recorder') as pulse:
+            if side == 'remote':
+                for sink_input in pulse.sink_input_list():
+                    app_name = sink_input.proplist.get('application.name', '')
+                    if any(keyword in app_name.lower() for keyword in CALL_STREAM_KEYWORDS):
+                        return [f'--monitor-stream={sink_input.index}']
+            else:
+                for source_output in pulse.source_output_list():
+                    app_name = source_output.proplist.get('application.name', '')
+                    if any(keyword in app_name.lower() for keyword in CALL_STREAM_KEYWORDS):
+                        return ['-d', pulse.source_info(source_output.source).name]
+        return None
+    
+    @staticmethod
+    def mix(remote, local):
+        """Mix two s16le chunks with clipping"""
+        size = min(len(remote), len(local))
+        size -= size % 2
+        a = array('h', remote[:size])
+        b = array('h', local[:size])
+        return array('h', [max(-32768, min(32767, x + y)) for x, y in zip(a, b)]).tobytes()
+
+
 class LinphoneDaemon:
     def __init__(self):
         self.states = LinphoneStates()
@@ -64,12 +338,21 @@ class LinphoneDaemon:
         self.running = True
         self.in_call = False
         self.current_call_number = None
+        self.current_call_state = None
+        self.current_call_recording = None
+        self.last_call_recording = ""
+        self.recording_path = None
         self.is_registered = False
         self.linphone_started = False
         
         # Initialize PulseAudio
         self.pulse = pulsectl.Pulse('linphoneui-daemon')
         
+        # Call recorder, files are kept next to the log directory
+        budget_mb = self.read_recording_budget()
+        self.recorder = CallRecorder(self.log_dir / 'recordings', budget_mb * 1024 * 1024,
+                                     on_finished=self.on_recording_finished)
+        
         # Initialize D-Bus with main loop
         self.setup_dbus()
         
@@ -82,6 +365,7 @@ class LinphoneDaemon:
         """Setup logging"""
         log_dir = Path.home() / '.local' / 'share' / 'LinphoneUI'
         log_dir.mkdir(parents=True, exist_ok=True)
+        self.log_dir = log_dir
         log_file = log_dir / 'linphone_daemon.log'
         
         logging.basicConfig(
@@ -94,6 +378,20 @@ class LinphoneDaemon:
         )
         self.logger = logging.getLogger('LinphoneDaemon')
     
+    def read_recording_budget(self, default=500):
+        """Read recordings disk budget (MB) from LINPHONEUI_RECORDING_BUDGET_MB"""
+        value = os.environ.get('LINPHONEUI_RECORDING_BUDGET_MB', '')
+        if not value:
+            return default
+        try:
+            budget_mb = int(value)
+            if budget_mb < 0:
+                raise ValueError("negative budget")
+            return budget_mb
+        except ValueError as e:
+            self.logger.error(f"Invalid LINPHONEUI_RECORDING_BUDGET_MB '{value}' ({e}), using {default}")
+            return default
+    
     def setup_dbus(self):
         """Setup D-Bus communication with main loop"""
         try:
@@ -292,7 +590,7 @@ class LinphoneDaemon:
                 props = sink_input.proplist
                 app_name = props.get('application.name', '')
                 
-                if any(keyword in app_name.lower() for keyword in ['linphone', 'call', 'voip']):
+                if any(keyword in app_name.lower() for keyword in CALL_STREAM_KEYWORDS):
                     for sink in self.pulse.sink_list():
                         if any(name in sink.name for name in ['handsfree', 'output', 'speaker']):
                             self.pulse.sink_input_move(sink_input.index, sink.index)
@@ -309,6 +607,43 @@ class LinphoneDaemon:
         except Exception as e:
             self.logger.error(f"Audio restore error: {e}")
     
+    def start_recording(self):
+        """Start recording the current call"""
+        if self.current_call_state != self.states.active.state:
+            self.logger.warning("Recording requested without an active call")
+            return False
+        missing = self.recorder.missing_tools()
+        if missing:
+            self.logger.error(f"Recording unavailable, missing tools: {', '.join(missing)}")
+            return False
+        if self.recording_path:
+            return True
+        self.recording_path = str(self.recorder.start(self.current_call_number))
+        self.current_call_recording = self.recording_path
+        self.dbus_object.emit_recording_state(True, self.recording_path)
+        return True
+    
+    def stop_recording(self):
+        """Stop recording, the encoder is flushed in the background"""
+        if not self.recording_path:
+            return False
+        self.recorder.stop()
+        self.dbus_object.emit_recording_state(False, self.recording_path)
+        self.recording_path = None
+        return True
+    
+    def on_recording_finished(self, path, error):
+        """Called from the recorder thread, hands the result to the main loop"""
+        def notify():
+            # Only sessions that ended on their own still need to be announced
+            if self.recording_path == str(path):
+                self.recording_path = None
+                self.dbus_object.emit_recording_state(False, str(path) if path.exists() else "")
+            if self.last_call_recording == str(path) and not path.exists():
+                self.last_call_recording = ""
+            return False
+        GLib.idle_add(notify)
+    
     def setMicHandler(self, micState):
         tolog = "Mic" + "ON" if micState else "OFF"
         self.logger.info(tolog)
@@ -318,6 +653,7 @@ class LinphoneDaemon:
         self.logger.info(f"Incoming call: {number}")
         self.in_call = True
         self.current_call_number = number
+        self.current_call_state = self.states.incoming.state
         
         # Launch GUI to show the call interface
         self.launch_gui()
@@ -333,6 +669,7 @@ class LinphoneDaemon:
         self.logger.info(f"Outgoing call: {number}")
         self.in_call = True
         self.current_call_number = number
+        self.current_call_state = self.states.outgoing.state
         
         # Notify GUI - передаем номер как строку
         self.dbus_object.emit_call_state("outgoing", str(number))
@@ -342,6 +679,7 @@ class LinphoneDaemon:
         self.logger.info(f"Call connected: {number}")
         self.in_call = True
         self.current_call_number = number
+        self.current_call_state = self.states.active.state
         
         # Notify GUI - передаем номер как строку
         self.dbus_object.emit_call_state("connected", str(number))
@@ -351,6 +689,12 @@ class LinphoneDaemon:
         self.logger.info("Call ended")
         self.in_call = False
         
+        self.stop_recording()
+        # Kept for the GUI, which attaches it to the call history entry
+        self.last_call_recording = self.current_call_recording or ""
+        if self.last_call_recording:
+            self.logger.info(f"Call recording: {self.last_call_recording}")
+        
         # Restore audio
         self.restore_audio()
         
@@ -358,6 +702,8 @@ class LinphoneDaemon:
         self.dbus_object.emit_call_state("ended", "")
         
         self.current_call_number = None
+        self.current_call_state = None
+        self.current_call_recording = None
 
 
     def monitor_linphone(self):
@@ -382,6 +728,7 @@ class LinphoneDaemon:
                     # New call detected
                     self.in_call = True
                     self.current_call_number = call_info['number']
+                    self.last_call_recording = ""
                     
                     self.states.GetExecByScrState(call_info['call_type'])(self.current_call_number)
 
@@ -406,6 +753,11 @@ class LinphoneDaemon:
         """Clean shutdown"""
         self.logger.info("Shutting down daemon...")
         self.running = False
+        self.recorder.stop_all()
+        self.stop_linphone()
+    
+    def stop_linphone(self):
+        """Stop linphonecsh"""
         try:
             subprocess.run(['linphonecsh', 'exit'], timeout=5)
         except:
@@ -429,6 +781,11 @@ class LinphoneDBusObject(dbus.service.Object):
         """Signal for call state changes with number"""
         pass
     
+    @dbus.service.signal('org.sailfishos.LinphoneUI', signature='bs')
+    def recording_state_changed(self, recording, path):
+        """Signal for call recording state changes with file path"""
+        pass
+    
     @dbus.service.method('org.sailfishos.LinphoneUI', in_signature='s', out_signature='b')
     def make_call(self, number):
         """Make call using linphonecsh"""
@@ -537,7 +894,7 @@ class LinphoneDBusObject(dbus.service.Object):
         try:
             self._log_call_action("Restarting linphone service")
             if self.daemon:
-                self.daemon.shutdown()
+                self.daemon.stop_linphone()
                 time.sleep(2)
                 self.daemon.start_linphone()
                 return True
@@ -555,6 +912,45 @@ class LinphoneDBusObject(dbus.service.Object):
         except Exception as e:
             logging.getLogger('LinphoneDaemon').error(f"Mic change error: {e}")
     
+    @dbus.service.method('org.sailfishos.LinphoneUI', in_signature='b', out_signature='b')
+    def setRecording(self, isRecording):
+        """Start or stop recording of the current call"""
+        try:
+            if isRecording:
+                return self.daemon.start_recording()
+            return self.daemon.stop_recording()
+        except Exception as e:
+            logging.getLogger('LinphoneDaemon').error(f"Recording change error: {e}")
+            return False
+    
+    @dbus.service.method('org.sailfishos.LinphoneUI', out_signature='s')
+    def get_recording_path(self):
+        """Get recording file of the current call, or of the last call once it ended"""
+        try:
+            if self.daemon.in_call:
+                path = self.daemon.current_call_recording or ""
+            else:
+                path = self.daemon.last_call_recording
+            # Evicted recordings must not end up in the call history
+            return path if path and Path(path).exists() else ""
+        except Exception as e:
+            logging.getLogger('LinphoneDaemon').error(f"Recording path error: {e}")
+            return ""
+    
+    @dbus.service.method('org.sailfishos.LinphoneUI', in_signature='u', out_signature='b')
+    def set_recording_budget(self, megabytes):
+        """Set disk budget for recordings in megabytes.
+        
+        Not persisted: the daemon starts with LINPHONEUI_RECORDING_BUDGET_MB again.
+        """
+        try:
+            self.daemon.recorder.budget_bytes = int(megabytes) * 1024 * 1024
+            threading.Thread(target=self.daemon.recorder.enforce_budget, daemon=True).start()
+            return True
+        except Exception as e:
+            logging.getLogger('LinphoneDaemon').error(f"Recording budget error: {e}")
+            return False
+    
     def _log_call_action(self, message):
         logging.getLogger('LinphoneDaemon').info(message)
     
@@ -566,6 +962,14 @@ class LinphoneDBusObject(dbus.service.Object):
         except Exception as e:
             logging.getLogger('LinphoneDaemon').error(f"Error emitting call state: {e}")
     
+    def emit_recording_state(self, recording, path):
+        """Send recording state change signal"""
+        try:
+            self.recording_state_changed(recording, str(path))
+            logging.getLogger('LinphoneDaemon').info(f"Emitted recording state signal: {recording}, {path}")
+        except Exception as e:
+            logging.getLogger('LinphoneDaemon').error(f"Error emitting recording state: {e}")
+    
     def emit_registration_state(self, registered):
         """Send registration state change signal"""
         try: